@@ -1,19 +1,52 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from contextlib import asynccontextmanager, suppress
+from cachetools import TTLCache
+import asyncio
+import hashlib
+import httpx
+import logging
+import logging.handlers
+import orjson
 import os
-import uuid
+import queue
+import re
+import secrets
+import time
 from dotenv import load_dotenv
-import tempfile
+from pathlib import Path
+from xml.sax.saxutils import escape
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTasks
 
 
 
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up and tear down everything the app needs: keys, cache dir, HTTP client, logging."""
+    if not all([ASSEMBLYAI_API_KEY, GOOGLE_API_KEY, AZURE_API_KEY, AZURE_REGION]):
+        raise RuntimeError("Missing API keys in .env file")
+    TTS_CACHE_DIR.mkdir(exist_ok=True)
+    # One pooled client so calls to AssemblyAI/Google/Azure reuse connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0),
+        # Idle connections stay open for a minute so polls and repeat calls skip the TLS handshake
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=60.0),
+    )
+    log_listener.start()
+    janitor = asyncio.create_task(tts_cache_janitor())
+    yield
+    janitor.cancel()
+    await app.state.http.aclose()
+    log_listener.stop()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 # Mount static directory (add this before your routes)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -26,6 +59,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class LimitUploadSize:
+    """Reject oversized /transcribe uploads from Content-Length before the body is read.
+
+    Plain ASGI rather than @app.middleware("http"), so every other request (static
+    files, streamed TTS audio) passes straight through without being re-piped.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/transcribe":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES:
+                        response = ORJSONResponse(status_code=413, content={"detail": "Audio file too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(LimitUploadSize)
+
 # Load environment variables from .env
 load_dotenv()
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
@@ -33,21 +89,177 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 AZURE_API_KEY = os.getenv("AZURE_API_KEY")
 AZURE_REGION = os.getenv("AZURE_REGION")
 
-# Ensure temp_audio directory exists
-os.makedirs("temp_audio", exist_ok=True)
-
-# Map Google language codes to Azure TTS voice names
-TTS_VOICES = {
-    "en": "en-US-JennyNeural",
-    "es": "es-ES-ElviraNeural", 
-    "fr": "fr-FR-DeniseNeural",
-    "de": "de-DE-KatjaNeural",
-    "fa": "fa-IR-FaridNeural",
-    "ar": "ar-SA-ZariyahNeural",
-    "zh": "zh-CN-XiaoxiaoNeural",
-    "ja": "ja-JP-NanamiNeural",
-    "ko": "ko-KR-SunHiNeural",
+# Log through a queue so stdout writes happen on a background thread, not the event loop
+logger = logging.getLogger("vt")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+
+# Upstream endpoints and headers, built once rather than on every request
+AAI_HEADERS = {"authorization": ASSEMBLYAI_API_KEY}
+AAI_JSON_HEADERS = {**AAI_HEADERS, "Content-Type": "application/json"}
+AAI_UPLOAD_URL = "https://api.assemblyai.com/v2/upload"
+AAI_TRANSCRIPT_URL = "https://api.assemblyai.com/v2/transcript"
+AAI_STREAMING_TOKEN_URL = "https://api.assemblyai.com/v2/streaming/token"
+AAI_STREAMING_TOKEN_HEADERS = {
+    "Authorization": f"Bearer {ASSEMBLYAI_API_KEY}",
+    "Content-Type": "application/json"
+}
+GOOGLE_TRANSLATE_URL = f"https://translation.googleapis.com/language/translate/v2?key={GOOGLE_API_KEY}"
+GOOGLE_TRANSLATE_HEADERS = {"Content-Type": "application/json"}
+AZURE_TTS_URL = f"https://{AZURE_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
+AZURE_TTS_HEADERS = {
+    "Ocp-Apim-Subscription-Key": AZURE_API_KEY,
+    "Content-Type": "application/ssml+xml",
+    "X-Microsoft-OutputFormat": "audio-24khz-96kbitrate-mono-mp3"
+}
+
+# Upload limits for /transcribe
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+
+# AssemblyAI polling: first delay, backoff cap and overall deadline (seconds)
+POLL_INITIAL = float(os.getenv("POLL_INITIAL", "0.5"))
+POLL_MAX = float(os.getenv("POLL_MAX", "3.0"))
+POLL_TIMEOUT = float(os.getenv("POLL_TIMEOUT", "180"))
+# Public base URL of this server; when set, AssemblyAI calls us back instead of being polled
+PUBLIC_URL = os.getenv("PUBLIC_URL")
+
+# Transcripts awaiting an AssemblyAI webhook, keyed by transcript ID
+pending_transcripts: dict[str, asyncio.Future] = {}
+
+# Long /translate inputs are split into chunks of at most this many characters,
+# and chunks are grouped into Google requests of at most TRANSLATE_REQUEST_CHARS
+TRANSLATE_CHUNK_CHARS = 4500
+TRANSLATE_REQUEST_CHARS = 30000
+
+# Translations are a pure function of (source, target, text), so keep recent ones in memory.
+# The cache is bounded by total characters, and very long translations are not kept at all
+TRANSLATE_CACHE_CHARS = 20_000_000
+TRANSLATE_CACHE_ENTRY_CHARS = 100_000
+translation_cache = TTLCache(maxsize=TRANSLATE_CACHE_CHARS, ttl=86400, getsizeof=len)
+
+# Upstream calls currently in progress, keyed like the caches, so identical
+# concurrent requests share one call instead of each making their own
+translations_inflight: dict[bytes, asyncio.Future] = {}
+tts_inflight: dict[str, asyncio.Future] = {}
+
+# Synthesized speech is cached on disk as tts_cache/<hash>.mp3, keyed by voice and text
+TTS_CACHE_DIR = Path("tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+# Every TTS_JANITOR_INTERVAL seconds the cache is pruned back to TTS_CACHE_MAX_BYTES,
+# and partial .tmp downloads left behind by a crash are swept up after an hour
+TTS_TMP_MAX_AGE = 3600
+TTS_JANITOR_INTERVAL = 300
+
+# Cache-key inputs above this size are hashed in a worker thread
+HASH_OFFLOAD_BYTES = 64 * 1024
+
+# Map Google language codes to the Azure TTS voice name and its xml:lang
+VOICE_AND_LANG = {
+    "en": ("en-US-JennyNeural", "en-US"),
+    "es": ("es-ES-ElviraNeural", "es-ES"),
+    "fr": ("fr-FR-DeniseNeural", "fr-FR"),
+    "de": ("de-DE-KatjaNeural", "de-DE"),
+    "fa": ("fa-IR-FaridNeural", "fa-IR"),
+    "ar": ("ar-SA-ZariyahNeural", "ar-SA"),
+    "zh": ("zh-CN-XiaoxiaoNeural", "zh-CN"),
+    "ja": ("ja-JP-NanamiNeural", "ja-JP"),
+    "ko": ("ko-KR-SunHiNeural", "ko-KR"),
 }
+# Unknown languages fall back to Farsi for both the voice and xml:lang
+DEFAULT_VOICE_AND_LANG = VOICE_AND_LANG["fa"]
+
+# Compact SSML body; text must be XML-escaped before it is substituted
+SSML_TEMPLATE = "<speak version='1.0' xml:lang='{lang}'><voice name='{voice}'>{text}</voice></speak>"
+
+def split_for_translation(text):
+    """Split text on sentence boundaries into chunks of at most TRANSLATE_CHUNK_CHARS.
+
+    Returns (chunk, separator) pairs, where separator is the whitespace that followed
+    the chunk in the original text, so newlines survive when the translations are joined.
+    """
+    if len(text) <= TRANSLATE_CHUNK_CHARS:
+        return [(text, "")]
+    parts = re.split(r"(?<=[.!?])(\s+)", text)
+    chunks = []
+    current = ""
+    current_sep = ""
+    for sentence, sep in zip(parts[::2], parts[1::2] + [""]):
+        # Hard-split any single sentence that is longer than a whole chunk
+        while len(sentence) > TRANSLATE_CHUNK_CHARS:
+            if current:
+                chunks.append((current, current_sep))
+                current = ""
+            cut = max(sentence.rfind(" ", 0, TRANSLATE_CHUNK_CHARS), sentence.rfind("\n", 0, TRANSLATE_CHUNK_CHARS))
+            if cut <= 0:
+                cut = TRANSLATE_CHUNK_CHARS
+            rest = sentence[cut:].lstrip()
+            chunks.append((sentence[:cut], sentence[cut:len(sentence) - len(rest)]))
+            sentence = rest
+        if not sentence:
+            # Only whitespace was left after a hard split; keep it with the previous chunk
+            if chunks and not current:
+                chunks[-1] = (chunks[-1][0], chunks[-1][1] + sep)
+            continue
+        if current and len(current) + len(current_sep) + len(sentence) > TRANSLATE_CHUNK_CHARS:
+            chunks.append((current, current_sep))
+            current = sentence
+        else:
+            current = current + current_sep + sentence if current else sentence
+        current_sep = sep
+    if current:
+        chunks.append((current, current_sep))
+    return chunks
+
+async def cache_digest(data):
+    """Return a 16-byte blake2b digest for cache keys, hashing large inputs off the event loop."""
+    if len(data) > HASH_OFFLOAD_BYTES:
+        return await asyncio.to_thread(lambda: hashlib.blake2b(data, digest_size=16).digest())
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def prune_tts_cache():
+    """Delete least recently used cached TTS files until the cache fits TTS_CACHE_MAX_BYTES."""
+    entries = []
+    for file in TTS_CACHE_DIR.glob("*.mp3"):
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            # Removed by a concurrent prune
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, file in entries:
+        if total <= TTS_CACHE_MAX_BYTES:
+            break
+        total -= size
+        file.unlink(missing_ok=True)
+        logger.debug("Pruned cached audio: %s", file)
+
+def remove_stale_tts_tmp_files():
+    """Delete .tmp files in the TTS cache older than TTS_TMP_MAX_AGE."""
+    cutoff = time.time() - TTS_TMP_MAX_AGE
+    for file in TTS_CACHE_DIR.glob("*.tmp"):
+        try:
+            if file.stat().st_mtime < cutoff:
+                file.unlink(missing_ok=True)
+                logger.info("Removed stale temp file: %s", file)
+        except FileNotFoundError:
+            continue
+
+async def tts_cache_janitor():
+    """Periodically sweep stale temp files and prune the cache to size, off the event loop."""
+    while True:
+        try:
+            await asyncio.to_thread(remove_stale_tts_tmp_files)
+            await asyncio.to_thread(prune_tts_cache)
+        except OSError as e:
+            logger.warning("TTS cache sweep failed: %s", e)
+        await asyncio.sleep(TTS_JANITOR_INTERVAL)
 
 @app.get("/")
 async def root(request: Request):
@@ -55,69 +267,136 @@ async def root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/transcribe")
-async def transcribe_audio(audio: UploadFile = File(...)):
+async def transcribe_audio(request: Request, audio: UploadFile = File(...)):
     """Transcribe audio (any language) using AssemblyAI with ALD."""
-    if not audio.content_type.startswith("audio/"):
-        raise HTTPException(status_code=400, detail="Invalid audio file")
-    unique_id = str(uuid.uuid4())
-    file_extension = os.path.splitext(audio.filename)[1].lower() or ".mp3"
-    input_path = f"temp_audio/input_{unique_id}{file_extension}"
+    if not (audio.content_type or "").startswith("audio/"):
+        raise HTTPException(status_code=415, detail="Invalid audio file")
+    client = request.app.state.http
+
+    async def file_iter():
+        # Forward the upload in 1 MiB chunks instead of buffering it to disk
+        sent = 0
+        while chunk := await audio.read(1 << 20):
+            sent += len(chunk)
+            # Content-Length can be absent with chunked uploads, so count as we go
+            if sent > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Audio file too large")
+            yield chunk
+
     try:
-        print(f"Saving audio to {input_path}")
-        with open(input_path, "wb") as f:
-            f.write(await audio.read())
-        headers = {"authorization": ASSEMBLYAI_API_KEY}
-        print(f"Uploading to AssemblyAI with key: {ASSEMBLYAI_API_KEY[:5]}...")
-        with open(input_path, "rb") as f:
-            response = requests.post(
-                "https://api.assemblyai.com/v2/upload",
-                headers=headers,
-                files={"file": f}
-            )
+        logger.debug("Uploading audio to AssemblyAI")
+        # /v2/upload takes the raw bytes as the body, sent with chunked encoding
+        response = await client.post(
+            AAI_UPLOAD_URL,
+            headers=AAI_HEADERS,
+            content=file_iter()
+        )
         response.raise_for_status()
-        audio_url = response.json()["upload_url"]
-        print(f"Audio URL: {audio_url}")
-        transcribe_response = requests.post(
-            "https://api.assemblyai.com/v2/transcript",
-            headers=headers,
-            json={"audio_url": audio_url, "language_detection": True}
+        audio_url = orjson.loads(response.content)["upload_url"]
+        logger.debug("Audio URL: %s", audio_url)
+        transcript_request = {"audio_url": audio_url, "language_detection": True}
+        if PUBLIC_URL:
+            transcript_request["webhook_url"] = f"{PUBLIC_URL.rstrip('/')}/assemblyai_callback"
+        transcribe_response = await client.post(
+            AAI_TRANSCRIPT_URL,
+            headers=AAI_JSON_HEADERS,
+            content=orjson.dumps(transcript_request)
         )
         transcribe_response.raise_for_status()
-        transcript_id = transcribe_response.json()["id"]
-        print(f"Transcript ID: {transcript_id}")
-        import time
-        for _ in range(30):
-            result = requests.get(
-                f"https://api.assemblyai.com/v2/transcript/{transcript_id}",
-                headers=headers
-            )
-            result.raise_for_status()
-            status = result.json()["status"]
-            print(f"Transcription status: {status}")
-            if status == "completed":
-                return {
-                    "text": result.json()["text"],
-                    "language_detected": result.json().get("language_code", "unknown")
-                }
-            elif status == "error":
-                raise HTTPException(status_code=500, detail=f"AssemblyAI error: {result.json()['error']}")
-            time.sleep(3)
+        transcript_id = orjson.loads(transcribe_response.content)["id"]
+        logger.info("Transcript ID: %s", transcript_id)
+        loop = asyncio.get_running_loop()
+        status = None
+        if PUBLIC_URL:
+            # Wait for /assemblyai_callback to hand over the finished transcript
+            pending_transcripts[transcript_id] = loop.create_future()
+            try:
+                transcript = await asyncio.wait_for(pending_transcripts[transcript_id], timeout=POLL_TIMEOUT)
+                status = transcript["status"]
+            except asyncio.TimeoutError:
+                # The webhook may never arrive (e.g. PUBLIC_URL unreachable); check once before giving up
+                logger.warning("No webhook for transcript %s, checking its status directly", transcript_id)
+                result = await client.get(
+                    f"{AAI_TRANSCRIPT_URL}/{transcript_id}",
+                    headers=AAI_HEADERS
+                )
+                result.raise_for_status()
+                transcript = orjson.loads(result.content)
+                status = transcript["status"]
+            finally:
+                pending_transcripts.pop(transcript_id, None)
+        else:
+            delay = POLL_INITIAL
+            deadline = loop.time() + POLL_TIMEOUT
+            while loop.time() < deadline:
+                result = await client.get(
+                    f"{AAI_TRANSCRIPT_URL}/{transcript_id}",
+                    headers=AAI_HEADERS
+                )
+                result.raise_for_status()
+                transcript = orjson.loads(result.content)
+                status = transcript["status"]
+                logger.debug("Transcription status: %s", status)
+                if status in ("completed", "error"):
+                    break
+                # Poll short clips quickly, then back off for longer ones
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, POLL_MAX)
+        if status == "completed":
+            return {
+                "text": transcript["text"],
+                "language_detected": transcript.get("language_code", "unknown")
+            }
+        elif status == "error":
+            raise HTTPException(status_code=500, detail=f"AssemblyAI error: {transcript['error']}")
         raise HTTPException(status_code=500, detail="Transcription timeout")
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error in /transcribe: {str(e)}")
+        logger.error("Error in /transcribe: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if os.path.exists(input_path):
-            os.remove(input_path)
-            print(f"Cleaned up: {input_path}")
+
+@app.post("/assemblyai_callback")
+async def assemblyai_callback(request: Request):
+    """Receive AssemblyAI's completion webhook and wake the waiting /transcribe call."""
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(payload, dict) or not isinstance(payload.get("transcript_id"), str):
+        raise HTTPException(status_code=400, detail="Expected an object with a transcript_id")
+    transcript_id = payload["transcript_id"]
+    future = pending_transcripts.get(transcript_id)
+    if future is None or future.done():
+        return {"status": "ignored"}
+    # Fetch the result ourselves rather than trusting the webhook body
+    result = await request.app.state.http.get(
+        f"{AAI_TRANSCRIPT_URL}/{transcript_id}",
+        headers=AAI_HEADERS
+    )
+    result.raise_for_status()
+    transcript = orjson.loads(result.content)
+    logger.debug("Transcription status: %s", transcript["status"])
+    if transcript["status"] in ("completed", "error") and not future.done():
+        future.set_result(transcript)
+    return {"status": "ok"}
 
 @app.post("/translate")
-async def translate_text(text: str = Form(...), source_language: str = Form(...), target_language: str = Form(...)):
+async def translate_text(request: Request, text: str = Form(...), source_language: str = Form(...), target_language: str = Form(...)):
     """Translate text from detected language to target language using Google Cloud Translation."""
+    cache_key = await cache_digest(f"{source_language}|{target_language}|{text}".encode())
+    if (cached := translation_cache.get(cache_key)) is not None:
+        return {"translated_text": cached}
+    if (inflight := translations_inflight.get(cache_key)) is not None:
+        # Share the result of the identical request already in progress; on failure, try ourselves
+        shared = await asyncio.shield(inflight)
+        if shared is not None:
+            return {"translated_text": shared}
+    future = asyncio.get_running_loop().create_future()
+    translations_inflight[cache_key] = future
     try:
         # Prepare the request data
         translate_data = {
-            "q": text,
             "target": target_language,
             "format": "text"
         }
@@ -126,102 +405,180 @@ async def translate_text(text: str = Form(...), source_language: str = Form(...)
         if source_language != 'auto':
             translate_data["source"] = source_language
         
-        print(f"Translation request - Text: {text[:50]}..., Source: {source_language}, Target: {target_language}")
-        
-        # Use the correct content type for Google Translate API
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            f"https://translation.googleapis.com/language/translate/v2?key={GOOGLE_API_KEY}",
-            headers=headers,
-            json=translate_data
-        )
-        
-        print(f"Google Translate response status: {response.status_code}")
-        
-        if response.status_code != 200:
-            # Don't expose the full error which might contain API key
-            print(f"Google Translate error response (status {response.status_code})")
-            if response.status_code == 400:
-                raise HTTPException(status_code=500, detail="Invalid translation request format")
-            elif response.status_code == 403:
-                raise HTTPException(status_code=500, detail="Google Translate API access denied - check API key")
-            else:
-                raise HTTPException(status_code=500, detail=f"Google Translate API error: {response.status_code}")
-        
-        result = response.json()
-        translated_text = result["data"]["translations"][0]["translatedText"]
+        logger.debug("Translation request - Text: %.50s..., Source: %s, Target: %s", text, source_language, target_language)
+
+        async def translate_chunks(chunks):
+            # Google accepts a list for "q" and returns one translation per element
+            response = await request.app.state.http.post(
+                GOOGLE_TRANSLATE_URL,
+                headers=GOOGLE_TRANSLATE_HEADERS,
+                content=orjson.dumps({**translate_data, "q": chunks})
+            )
+            
+            logger.debug("Google Translate response status: %s", response.status_code)
+            
+            if response.status_code != 200:
+                # Don't expose the full error which might contain API key
+                logger.error("Google Translate error response (status %s)", response.status_code)
+                if response.status_code == 400:
+                    raise HTTPException(status_code=500, detail="Invalid translation request format")
+                elif response.status_code == 403:
+                    raise HTTPException(status_code=500, detail="Google Translate API access denied - check API key")
+                else:
+                    raise HTTPException(status_code=500, detail=f"Google Translate API error: {response.status_code}")
+            
+            result = orjson.loads(response.content)
+            return [t["translatedText"] for t in result["data"]["translations"]]
+
+        # Batch chunks into as few requests as possible and send those concurrently
+        shards = [[]]
+        shard_size = 0
+        pieces = split_for_translation(text)
+        for chunk, _ in pieces:
+            if shards[-1] and shard_size + len(chunk) > TRANSLATE_REQUEST_CHARS:
+                shards.append([])
+                shard_size = 0
+            shards[-1].append(chunk)
+            shard_size += len(chunk)
+        results = await asyncio.gather(*(translate_chunks(shard) for shard in shards))
+        translated = (t for shard in results for t in shard)
+        # Put back the whitespace each split consumed (newlines, or nothing for CJK)
+        translated_text = "".join(t + sep for t, (_, sep) in zip(translated, pieces))
+        if len(translated_text) <= TRANSLATE_CACHE_ENTRY_CHARS:
+            translation_cache[cache_key] = translated_text
+        future.set_result(translated_text)
         
-        print(f"Translation successful: {translated_text[:50]}...")
+        logger.info("Translation successful: %.50s...", translated_text)
         return {"translated_text": translated_text}
         
-    except requests.exceptions.RequestException as e:
-        print(f"Request error in /translate: {str(e)}")
+    except httpx.HTTPError as e:
+        logger.error("Request error in /translate: %s", e)
         raise HTTPException(status_code=500, detail=f"Translation service error: {str(e)}")
     except KeyError as e:
-        print(f"Response format error in /translate: {str(e)}")
+        logger.error("Response format error in /translate: %s", e)
         raise HTTPException(status_code=500, detail=f"Invalid response from translation service: {str(e)}")
     except Exception as e:
-        print(f"Unexpected error in /translate: {str(e)}")
+        logger.error("Unexpected error in /translate: %s", e)
         raise HTTPException(status_code=500, detail=f"Translation failed: {str(e)}")
     except Exception as e:
-        print(f"Error in /translate: {str(e)}")
+        logger.error("Error in /translate: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if translations_inflight.get(cache_key) is future:
+            del translations_inflight[cache_key]
+        if not future.done():
+            future.set_result(None)
 
 @app.post("/tts")
-async def text_to_speech(text: str = Form(...), language: str = Form(...)):
+async def text_to_speech(request: Request, text: str = Form(...), language: str = Form(...)):
     """Convert text to speech using Azure TTS with language-specific voice."""
-    # Use tempfile.NamedTemporaryFile to ensure unique file name and proper cleanup
-    with tempfile.NamedTemporaryFile(suffix=".mp3", dir="temp_audio", delete=False) as temp_file:
-        output_path = temp_file.name
+    try:
+        voice, lang_code = VOICE_AND_LANG.get(language, DEFAULT_VOICE_AND_LANG)
+        cache_key = (await cache_digest((voice + "\x00" + text).encode())).hex()
+        # The audio is a pure function of (voice, text), so the key doubles as a strong ETag
+        cache_headers = {"ETag": f'"{cache_key}"', "Cache-Control": "public, max-age=31536000, immutable"}
+        if request.headers.get("if-none-match") == cache_headers["ETag"]:
+            return Response(status_code=304, headers=cache_headers)
+        output_path = TTS_CACHE_DIR / f"{cache_key}.mp3"
+        if output_path.exists():
+            # Refresh mtime so the pruner treats this file as recently used
+            os.utime(output_path)
+            logger.debug("Serving cached audio file: %s", output_path)
+            return FileResponse(output_path, media_type="audio/mpeg", filename=f"tts_{cache_key}.mp3", headers=cache_headers)
+        if (inflight := tts_inflight.get(cache_key)) is not None:
+            # Wait for the identical request already synthesizing this audio to cache it;
+            # its response resolves the future even if that client disconnects early
+            await asyncio.shield(inflight)
+            if output_path.exists():
+                logger.debug("Serving cached audio file: %s", output_path)
+                return FileResponse(output_path, media_type="audio/mpeg", filename=f"tts_{cache_key}.mp3", headers=cache_headers)
+        future = asyncio.get_running_loop().create_future()
+        tts_inflight[cache_key] = future
+
+        def finish_inflight():
+            if tts_inflight.get(cache_key) is future:
+                del tts_inflight[cache_key]
+            if not future.done():
+                future.set_result(None)
+
+        ssml = SSML_TEMPLATE.format(lang=lang_code, voice=voice, text=escape(text))
+        logger.debug("Sending TTS request: language=%s, voice=%s, text=%s", lang_code, voice, text)
+        client = request.app.state.http
         try:
-            voice = TTS_VOICES.get(language, "fa-IR-FaridNeural")
-            lang_code = language if language in TTS_VOICES else "fa-IR"
-            headers = {
-                "Ocp-Apim-Subscription-Key": AZURE_API_KEY,
-                "Content-Type": "application/ssml+xml",
-                "X-Microsoft-OutputFormat": "audio-24khz-96kbitrate-mono-mp3"
-            }
-            ssml = f"""
-            <speak version='1.0' xml:lang='{lang_code}'>
-                <voice name='{voice}'>{text}</voice>
-            </speak>
-            """
-            print(f"Sending TTS request: language={lang_code}, voice={voice}, text={text}")
-            response = requests.post(
-                f"https://{AZURE_REGION}.tts.speech.microsoft.com/cognitiveservices/v1",
-                headers=headers,
-                data=ssml.encode("utf-8")
+            response = await client.send(
+                client.build_request(
+                    "POST",
+                    AZURE_TTS_URL,
+                    headers=AZURE_TTS_HEADERS,
+                    content=ssml.encode("utf-8")
+                ),
+                stream=True
             )
-            print(f"Azure TTS response status: {response.status_code}")
+            logger.debug("Azure TTS response status: %s", response.status_code)
             if response.status_code != 200:
-                print(f"Azure TTS response: {response.text}")
+                await response.aread()
+                await response.aclose()
+                logger.error("Azure TTS response: %s", response.text)
                 raise HTTPException(status_code=500, detail=f"Azure TTS error: {response.text}")
-            with open(output_path, "wb") as f:
-                f.write(response.content)
-            if not os.path.exists(output_path):
-                raise HTTPException(status_code=500, detail=f"Failed to create audio file: {output_path}")
-            print(f"Created audio file: {output_path}")
-            return FileResponse(output_path, media_type="audio/mpeg", filename=f"output_{os.path.basename(output_path)}")
-        except Exception as e:
-            print(f"Error in /tts: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
-        finally:
-            # Defer cleanup to after FileResponse is served
-            pass
-@app.on_event("shutdown")
-async def cleanup_temp_files():
-    """Clean up temporary files on shutdown."""
-    import glob
-    for file in glob.glob("temp_audio/output_*.mp3"):
-        try:
-            if os.path.exists(file):
-                os.remove(file)
-                print(f"Cleaned up: {file}")
-        except Exception as e:
-            print(f"Error cleaning up {file}: {str(e)}")
+        except BaseException:
+            finish_inflight()
+            raise
+
+        async def stream_and_cache():
+            # Pass audio through as Azure emits it, keeping a copy for the cache.
+            # Write to a temporary name first so readers never see a partial file.
+            # Disk I/O runs in worker threads so a slow filesystem can't stall the loop
+            # A failing cache write (disk full, permissions) only stops caching, never the relay
+            tmp_path = TTS_CACHE_DIR / f"{cache_key}.{secrets.token_hex(8)}.tmp"
+            f = None
+            try:
+                try:
+                    f = await asyncio.to_thread(open, tmp_path, "wb")
+                except OSError as e:
+                    logger.warning("Not caching %s: %s", output_path, e)
+                async for chunk in response.aiter_bytes(65536):
+                    yield chunk
+                    if f is not None:
+                        try:
+                            await asyncio.to_thread(f.write, chunk)
+                        except OSError as e:
+                            logger.warning("Not caching %s: %s", output_path, e)
+                            failed, f = f, None
+                            with suppress(OSError):
+                                await asyncio.to_thread(failed.close)
+                if f is not None:
+                    try:
+                        done, f = f, None
+                        await asyncio.to_thread(done.close)
+                        await asyncio.to_thread(os.replace, tmp_path, output_path)
+                        logger.info("Created audio file: %s", output_path)
+                    except OSError as e:
+                        logger.warning("Not caching %s: %s", output_path, e)
+            finally:
+                finish_inflight()
+                await response.aclose()
+                if f is not None:
+                    with suppress(OSError):
+                        await asyncio.to_thread(f.close)
+                try:
+                    await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+                except OSError as e:
+                    logger.warning("Could not clean up %s: %s", tmp_path, e)
+
+        # Background tasks run even if the client disconnects before the body is iterated,
+        # when stream_and_cache's cleanup never gets a chance to run
+        cleanup = BackgroundTasks()
+        cleanup.add_task(finish_inflight)
+        cleanup.add_task(response.aclose)
+        return StreamingResponse(
+            stream_and_cache(),
+            media_type="audio/mpeg",
+            headers={**cache_headers, "Content-Disposition": f'attachment; filename="tts_{cache_key}.mp3"'},
+            background=cleanup
+        )
+    except Exception as e:
+        logger.error("Error in /tts: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 
@@ -235,38 +592,33 @@ async def change_translation(request: Request):
     return templates.TemplateResponse("change.html", {"request": request})
 
 @app.get("/get-realtime-token")
-async def get_realtime_token():
+async def get_realtime_token(request: Request):
     """Get a real-time token for AssemblyAI Universal Streaming API."""
     try:
-        headers = {
-            "Authorization": f"Bearer {ASSEMBLYAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
         # Use Universal Streaming API
-        response = requests.post(
-            "https://api.assemblyai.com/v2/streaming/token",
-            headers=headers,
-            json={"expires_in": 3600}  # Token expires in 1 hour
+        response = await request.app.state.http.post(
+            AAI_STREAMING_TOKEN_URL,
+            headers=AAI_STREAMING_TOKEN_HEADERS,
+            content=orjson.dumps({"expires_in": 3600})  # Token expires in 1 hour
         )
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except Exception as e:
-        print(f"Error getting realtime token: {str(e)}")
+        logger.error("Error getting realtime token: %s", e)
         # For now, return a simple message since the API might be deprecated
         return {"error": "Real-time API unavailable", "message": "Please use Web Speech API instead"}
 
 
+if __name__ == "__main__":
+    import uvicorn
+    # Run on uvloop + httptools (installed from requirements.txt where supported)
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, loop="auto", http="auto")
 
 
 
 
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Ensure API keys are loaded."""
-    if not all([ASSEMBLYAI_API_KEY, GOOGLE_API_KEY, AZURE_API_KEY, AZURE_REGION]):
-        raise RuntimeError("Missing API keys in .env file")
 # from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 # from fastapi.responses import FileResponse
 # from fastapi.templating import Jinja2Templates
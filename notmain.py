@@ -1,15 +1,21 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from starlette.background import BackgroundTask
+import asyncio
+import httpx
+import logging
+import orjson
 import os
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import tempfile
 import assemblyai as aai
-app = FastAPI()
+from async_lru import alru_cache
+from xml.sax.saxutils import escape
+app = FastAPI(default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
+logger = logging.getLogger("voice_translator")
 
 # Add CORS middleware
 app.add_middleware(
@@ -20,16 +26,51 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class LimitUploadSize:
+    """Reject oversized audio uploads from Content-Length before the body is read.
+
+    Plain ASGI rather than @app.middleware("http"), so other requests (including
+    streamed TTS audio) pass straight through without being re-piped.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in UPLOAD_PATHS:
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_MB * 1024 * 1024:
+                        response = ORJSONResponse(status_code=413, content={"detail": "File too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(LimitUploadSize)
+
 # Load environment variables from .env
 load_dotenv()
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 AZURE_API_KEY = os.getenv("AZURE_API_KEY")
 AZURE_REGION = os.getenv("AZURE_REGION")
-# Initialize AssemblyAI client
-aai.settings.api_key = os.getenv("ASSEMBLYAI_API_KEY")
-# Ensure temp_audio directory exists
-os.makedirs("temp_audio", exist_ok=True)
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "200"))
+# Routes that accept audio uploads and are size-checked by LimitUploadSize
+UPLOAD_PATHS = {"/transcribe", "/speak"}
+
+# Upstream endpoints and headers, built once rather than on every request
+AAI_STREAMING_TOKEN_URL = "https://streaming.assemblyai.com/v3/token"
+AAI_HEADERS = {"Authorization": ASSEMBLYAI_API_KEY}
+GOOGLE_TRANSLATE_URL = "https://translation.googleapis.com/language/translate/v2"
+# Key goes in a header rather than the query string so it never shows up in error messages
+GOOGLE_TRANSLATE_HEADERS = {"x-goog-api-key": GOOGLE_API_KEY}
+AZURE_TTS_URL = f"https://{AZURE_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
+AZURE_TTS_HEADERS = {
+    "Ocp-Apim-Subscription-Key": AZURE_API_KEY,
+    "Content-Type": "application/ssml+xml",
+    "X-Microsoft-OutputFormat": "audio-24khz-96kbitrate-mono-mp3"
+}
 
 # Map Google language codes to Azure TTS voice names
 TTS_VOICES = {
@@ -40,176 +81,211 @@ TTS_VOICES = {
     "fa": "fa-IR-FaridNeural",
 }
 
+# One SSML document per language with the voice and xml:lang filled in up front;
+# only the (XML-escaped) text is substituted per request
+SSML_TEMPLATES = {
+    language: (
+        f"<speak version='1.0' xml:lang='{voice.rsplit('-', 1)[0]}'>"
+        f"<voice name='{voice}'>{{text}}</voice></speak>"
+    )
+    for language, voice in TTS_VOICES.items()
+}
+
+# Short texts (UI labels, repeated captions) are cached; longer ones always go to Google
+TRANSLATE_CACHE_MAX_BYTES = 2048
+# Most "q" segments Google Translate v2 accepts in one request
+TRANSLATE_BATCH_SEGMENTS = 128
+# Largest /translate_batch accepted, which bounds how many groups are sent at once
+TRANSLATE_BATCH_MAX_TEXTS = 1024
+
+async def fetch_translation(text, source_language, target_language):
+    """Translate one text with Google Cloud Translation."""
+    payload = {"q": text, "target": target_language, "format": "text"}
+    # Without a source language Google detects it itself
+    if source_language:
+        payload["source"] = source_language
+    response = await app.state.http.post(GOOGLE_TRANSLATE_URL, headers=GOOGLE_TRANSLATE_HEADERS, json=payload)
+    response.raise_for_status()
+    return orjson.loads(response.content)["data"]["translations"][0]["translatedText"]
+
+# LRU over (text, source, target); failed lookups are not cached
+cached_translation = alru_cache(maxsize=4096)(fetch_translation)
+
+async def translate(text, source_language, target_language):
+    """Translate through the LRU cache unless the text is too large to keep."""
+    if len(text.encode("utf-8")) > TRANSLATE_CACHE_MAX_BYTES:
+        return await fetch_translation(text, source_language, target_language)
+    return await cached_translation(text, source_language, target_language)
+
+def upstream_error(route, e):
+    """Log a failed request and turn the error into an HTTPException (504 on upstream timeout)."""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, httpx.TimeoutException):
+        logger.error("Upstream timeout in %s: %s", route, e)
+        return HTTPException(status_code=504, detail="upstream timeout")
+    if isinstance(e, httpx.HTTPStatusError):
+        # Don't expose the full error, its message includes the upstream URL
+        logger.error("Upstream error in %s: status %s", route, e.response.status_code)
+        return HTTPException(status_code=500, detail=f"Upstream service error: {e.response.status_code}")
+    logger.error("Error in %s: %s", route, e)
+    return HTTPException(status_code=500, detail=str(e))
+
+async def transcribe_upload(request, audio):
+    """Validate an uploaded recording and transcribe it with AssemblyAI language detection."""
+    if not (audio.content_type or "").startswith("audio/"):
+        raise HTTPException(status_code=400, detail="Invalid audio file")
+    # Chunked uploads carry no Content-Length, so check the parsed size as well
+    if audio.size is not None and audio.size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail="File too large")
+    # Hand the SDK the spooled upload file so it streams it in chunks
+    # instead of holding the whole recording in memory.
+    # The blocking upload/submit/poll runs on the loop's default thread pool
+    logger.debug("Transcribing with AssemblyAI SDK")
+    transcript = await asyncio.to_thread(
+        request.app.state.aai.transcribe, audio.file, config=aai.TranscriptionConfig(language_detection=True)
+    )
+    logger.debug("Transcription status: %s", transcript.status)
+    if transcript.status == aai.TranscriptStatus.error:
+        raise HTTPException(status_code=500, detail=f"AssemblyAI error: {transcript.error}")
+    return transcript
+
+async def stream_tts(client, text, language):
+    """Synthesize text with Azure TTS and relay the MP3 as it is produced."""
+    ssml = SSML_TEMPLATES.get(language, SSML_TEMPLATES["fa"]).format(text=escape(text))
+    logger.debug("Sending TTS request: language=%s, text=%s", language, text)
+    req = client.build_request(
+        "POST",
+        AZURE_TTS_URL,
+        headers=AZURE_TTS_HEADERS,
+        content=ssml.encode("utf-8")
+    )
+    response = await client.send(req, stream=True)
+    logger.debug("Azure TTS response status: %s", response.status_code)
+    if response.status_code != 200:
+        await response.aread()
+        await response.aclose()
+        logger.error("Azure TTS response: %s", response.text)
+        raise HTTPException(status_code=500, detail=f"Azure TTS error: {response.text}")
+
+    async def audio_chunks():
+        # Relay the MP3 to the client as Azure produces it, without touching disk
+        try:
+            async for chunk in response.aiter_bytes(64 * 1024):
+                yield chunk
+        finally:
+            await response.aclose()
+
+    return StreamingResponse(
+        audio_chunks(),
+        media_type="audio/mpeg",
+        headers={"Content-Disposition": 'attachment; filename="output.mp3"'},
+        # Also runs if the client disconnects before audio_chunks() is ever started
+        background=BackgroundTask(response.aclose)
+    )
+
 @app.get("/")
 async def root(request: Request):
     """Serve the HTML form."""
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/transcribe")
-async def transcribe_audio(audio: UploadFile = File(...)):
+async def transcribe_audio(request: Request, audio: UploadFile = File(...)):
     """Transcribe audio (any language) using AssemblyAI with ALD."""
-    if not audio.content_type.startswith("audio/"):
-        raise HTTPException(status_code=400, detail="Invalid audio file")
-    unique_id = str(uuid.uuid4())
-    file_extension = os.path.splitext(audio.filename)[1].lower() or ".mp3"
-    input_path = f"temp_audio/input_{unique_id}{file_extension}"
     try:
-        print(f"Saving audio to {input_path}")
-        with open(input_path, "wb") as f:
-            f.write(await audio.read())
-        headers = {"authorization": ASSEMBLYAI_API_KEY}
-        print(f"Uploading to AssemblyAI with key: {ASSEMBLYAI_API_KEY[:5]}...")
-        with open(input_path, "rb") as f:
-            response = requests.post(
-                "https://api.assemblyai.com/v2/upload",
-                headers=headers,
-                files={"file": f}
-            )
-        response.raise_for_status()
-        audio_url = response.json()["upload_url"]
-        print(f"Audio URL: {audio_url}")
-        transcribe_response = requests.post(
-            "https://api.assemblyai.com/v2/transcript",
-            headers=headers,
-            json={"audio_url": audio_url, "language_detection": True}
-        )
-        transcribe_response.raise_for_status()
-        transcript_id = transcribe_response.json()["id"]
-        print(f"Transcript ID: {transcript_id}")
-        import time
-        for _ in range(30):
-            result = requests.get(
-                f"https://api.assemblyai.com/v2/transcript/{transcript_id}",
-                headers=headers
-            )
-            result.raise_for_status()
-            status = result.json()["status"]
-            print(f"Transcription status: {status}")
-            if status == "completed":
-                return {
-                    "text": result.json()["text"],
-                    "language_detected": result.json().get("language_code", "unknown")
-                }
-            elif status == "error":
-                raise HTTPException(status_code=500, detail=f"AssemblyAI error: {result.json()['error']}")
-            time.sleep(3)
-        raise HTTPException(status_code=500, detail="Transcription timeout")
+        transcript = await transcribe_upload(request, audio)
+        return {
+            "text": transcript.text,
+            "language_detected": transcript.json_response.get("language_code", "unknown")
+        }
     except Exception as e:
-        print(f"Error in /transcribe: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if os.path.exists(input_path):
-            os.remove(input_path)
-            print(f"Cleaned up: {input_path}")
+        raise upstream_error("/transcribe", e)
 
 @app.post("/translate")
-async def translate_text(text: str = Form(...), source_language: str = Form(...), target_language: str = Form(...)):
+async def translate_text(request: Request, text: str = Form(...), source_language: str = Form(...), target_language: str = Form(...)):
     """Translate text from detected language to target language using Google Cloud Translation."""
     try:
-        response = requests.post(
-            f"https://translation.googleapis.com/language/translate/v2?key={GOOGLE_API_KEY}",
-            json={
-                "q": text,
-                "source": source_language,
-                "target": target_language,
-                "format": "text"
-            }
-        )
-        response.raise_for_status()
-        translated_text = response.json()["data"]["translations"][0]["translatedText"]
+        translated_text = await translate(text, source_language, target_language)
         return {"translated_text": translated_text}
     except Exception as e:
-        print(f"Error in /translate: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error("/translate", e)
+
+@app.post("/translate_batch")
+async def translate_batch(request: Request, texts: list[str] = Form(...), source_language: str = Form(...), target_language: str = Form(...)):
+    """Translate several texts in one Google Cloud Translation round trip."""
+    if len(texts) > TRANSLATE_BATCH_MAX_TEXTS:
+        raise HTTPException(status_code=413, detail=f"At most {TRANSLATE_BATCH_MAX_TEXTS} texts per batch")
+
+    async def translate_group(group):
+        # Google accepts a list for "q" and returns the translations in the same order
+        payload = {"q": group, "target": target_language, "format": "text"}
+        # Without a source language Google detects it itself
+        if source_language:
+            payload["source"] = source_language
+        response = await request.app.state.http.post(GOOGLE_TRANSLATE_URL, headers=GOOGLE_TRANSLATE_HEADERS, json=payload)
+        response.raise_for_status()
+        return [t["translatedText"] for t in orjson.loads(response.content)["data"]["translations"]]
+
+    try:
+        # Google rejects more than TRANSLATE_BATCH_SEGMENTS texts per request, so send groups concurrently
+        groups = [texts[i:i + TRANSLATE_BATCH_SEGMENTS] for i in range(0, len(texts), TRANSLATE_BATCH_SEGMENTS)]
+        results = await asyncio.gather(*(translate_group(group) for group in groups))
+        translated_texts = [t for group in results for t in group]
+        return {"translated_texts": translated_texts}
+    except Exception as e:
+        raise upstream_error("/translate_batch", e)
 
 @app.post("/tts")
-async def text_to_speech(text: str = Form(...), language: str = Form(...)):
+async def text_to_speech(request: Request, text: str = Form(...), language: str = Form(...)):
     """Convert text to speech using Azure TTS with language-specific voice."""
-    # Use tempfile.NamedTemporaryFile to ensure unique file name and proper cleanup
-    with tempfile.NamedTemporaryFile(suffix=".mp3", dir="temp_audio", delete=False) as temp_file:
-        output_path = temp_file.name
-        try:
-            voice = TTS_VOICES.get(language, "fa-IR-FaridNeural")
-            lang_code = language if language in TTS_VOICES else "fa-IR"
-            headers = {
-                "Ocp-Apim-Subscription-Key": AZURE_API_KEY,
-                "Content-Type": "application/ssml+xml",
-                "X-Microsoft-OutputFormat": "audio-24khz-96kbitrate-mono-mp3"
-            }
-            ssml = f"""
-            <speak version='1.0' xml:lang='{lang_code}'>
-                <voice name='{voice}'>{text}</voice>
-            </speak>
-            """
-            print(f"Sending TTS request: language={lang_code}, voice={voice}, text={text}")
-            response = requests.post(
-                f"https://{AZURE_REGION}.tts.speech.microsoft.com/cognitiveservices/v1",
-                headers=headers,
-                data=ssml.encode("utf-8")
-            )
-            print(f"Azure TTS response status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"Azure TTS response: {response.text}")
-                raise HTTPException(status_code=500, detail=f"Azure TTS error: {response.text}")
-            with open(output_path, "wb") as f:
-                f.write(response.content)
-            if not os.path.exists(output_path):
-                raise HTTPException(status_code=500, detail=f"Failed to create audio file: {output_path}")
-            print(f"Created audio file: {output_path}")
-            return FileResponse(output_path, media_type="audio/mpeg", filename=f"output_{os.path.basename(output_path)}")
-        except Exception as e:
-            print(f"Error in /tts: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
-        finally:
-            # Defer cleanup to after FileResponse is served
-            pass
+    try:
+        return await stream_tts(request.app.state.http, text, language)
+    except Exception as e:
+        raise upstream_error("/tts", e)
+
+@app.post("/speak")
+async def speak(request: Request, audio: UploadFile = File(...), target_language: str = Form(...)):
+    """Transcribe, translate and synthesize in one request, streaming the MP3 back."""
+    try:
+        # Same three upstream calls the browser would otherwise make one by one,
+        # all sharing the pooled client so the connections stay warm
+        transcript = await transcribe_upload(request, audio)
+        if not transcript.text:
+            raise HTTPException(status_code=422, detail="No speech detected")
+        # language_code is present but None when detection failed; leave it to Google then
+        source_language = transcript.json_response.get("language_code")
+        logger.debug("Speak: transcribed %d chars, language=%s", len(transcript.text), source_language)
+        translated_text = await translate(transcript.text, source_language, target_language)
+        return await stream_tts(request.app.state.http, translated_text, target_language)
+    except Exception as e:
+        raise upstream_error("/speak", e)
+
 @app.on_event("shutdown")
-async def cleanup_temp_files():
-    """Clean up temporary files on shutdown."""
-    import glob
-    for file in glob.glob("temp_audio/output_*.mp3"):
-        try:
-            if os.path.exists(file):
-                os.remove(file)
-                print(f"Cleaned up: {file}")
-        except Exception as e:
-            print(f"Error cleaning up {file}: {str(e)}")
+async def shutdown_event():
+    """Close the shared HTTP client."""
+    await app.state.http.aclose()
 
 
 @app.get("/get-realtime-token")
-async def get_realtime_token():
+async def get_realtime_token(request: Request):
+    # Temporary streaming tokens are meant for one session, so mint a fresh one per call
+    # rather than handing the same token to several browsers
     try:
         # Make sure the API key is set
         if not ASSEMBLYAI_API_KEY:
             raise Exception("AssemblyAI API key not found")
             
-        print(f"Using AssemblyAI API key: {ASSEMBLYAI_API_KEY[:8]}...")
-        
-        # First, test if the API key works with a basic call
-        test_headers = {"authorization": ASSEMBLYAI_API_KEY}
-        test_response = requests.get(
-            "https://api.assemblyai.com/v2/transcript",
-            headers=test_headers
-        )
-        print(f"API key test response: {test_response.status_code}")
-        
-        if test_response.status_code == 401:
-            raise Exception("Invalid AssemblyAI API key - basic API test failed")
-        
-        # Now try to get Universal Streaming token using the new API endpoint
-        headers = {
-            "Authorization": ASSEMBLYAI_API_KEY,
-        }
+        logger.debug("Requesting Universal Streaming token")
         
-        # Create the token request using the new Universal Streaming endpoint
-        response = requests.get(
-            "https://streaming.assemblyai.com/v3/token",
-            headers=headers,
+        # Get Universal Streaming token using the new API endpoint;
+        # a bad key shows up as a 401 here, so no separate key check is needed
+        response = await request.app.state.http.get(
+            AAI_STREAMING_TOKEN_URL,
+            headers=AAI_HEADERS,
             params={"expires_in_seconds": 600}  # 10 minutes (max 600)
         )
         
-        print(f"Universal Streaming token API response status: {response.status_code}")
-        print(f"Universal Streaming token API response text: {response.text}")
+        logger.debug("Universal Streaming token API response status: %s", response.status_code)
         
         if response.status_code == 401:
             raise Exception("Invalid AssemblyAI API key for Universal Streaming API")
@@ -221,10 +297,10 @@ async def get_realtime_token():
             raise Exception(f"AssemblyAI Universal Streaming API returned {response.status_code}: {response.text}")
         
         try:
-            token_data = response.json()
+            token_data = orjson.loads(response.content)
             if "token" not in token_data:
                 raise Exception(f"No token in response: {token_data}")
-            print("Successfully created Universal Streaming token")
+            logger.info("Successfully created Universal Streaming token")
             return {
                 "token": token_data["token"],
                 "api_host": "streaming.assemblyai.com",
@@ -233,14 +309,16 @@ async def get_realtime_token():
         except ValueError as json_error:
             raise Exception(f"Invalid JSON response: {response.text}")
             
-    except requests.exceptions.RequestException as req_error:
-        print(f"Request error: {req_error}")
+    except httpx.TimeoutException as e:
+        raise upstream_error("/get-realtime-token", e)
+    except httpx.HTTPError as req_error:
+        logger.error("Request error: %s", req_error)
         raise HTTPException(
             status_code=500,
             detail=f"Network error connecting to AssemblyAI: {str(req_error)}"
         )
     except Exception as e:
-        print(f"Error creating Universal Streaming token: {str(e)}")
+        logger.error("Error creating Universal Streaming token: %s", e)
         raise HTTPException(
             status_code=500, 
             detail=f"Failed to create Universal Streaming token: {str(e)}"
@@ -253,6 +331,37 @@ async def get_realtime_token():
 
 @app.on_event("startup")
 async def startup_event():
-    """Ensure API keys are loaded."""
+    """Configure logging, ensure API keys are loaded and create the shared API clients."""
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
     if not all([ASSEMBLYAI_API_KEY, GOOGLE_API_KEY, AZURE_API_KEY, AZURE_REGION]):
-        raise RuntimeError("Missing API keys in .env file")
\ No newline at end of file
+        raise RuntimeError("Missing API keys in .env file")
+    # Each in-flight transcription holds a worker thread while the SDK polls,
+    # so size the pool for concurrency instead of the CPU-derived default
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=32))
+    # One AssemblyAI transcriber for the app, so its connection pool stays warm
+    aai.settings.api_key = ASSEMBLYAI_API_KEY
+    app.state.aai = aai.Transcriber()
+    # One pooled client so calls to AssemblyAI/Google/Azure reuse connections
+    # Bounded timeouts so a hung upstream can't pin a request forever; the transport
+    # retries failed connects (not requests) twice. Limits go on the transport
+    # because the client ignores its own when a transport is given.
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=5.0),
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        ),
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools where installed, one worker process per core (override with WEB_CONCURRENCY)
+    uvicorn.run(
+        "notmain:app",
+        host="127.0.0.1",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="auto",
+        http="auto",
+    )